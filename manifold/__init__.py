@@ -1,3 +1,3 @@
-from .exactsearch import ExactSearch, ExactSearchBatch
+from .exactsearch import ExactSearch, ExactSearchBatch, gather_exact
 from .syntheticaccessibility import SyntheticAccessibilityFast, SyntheticAccessibilityFastBatch
 from .syntheticaccessibility import SyntheticAccessibilityRetroSynthesis, SyntheticAccessibilityRetroSynthesisBatch
@@ -1,35 +1,97 @@
+import asyncio
 from dataclasses import dataclass
-import requests
-from typing import Dict, List, Optional
-from simplejson.errors import JSONDecodeError
+import functools
+from typing import Dict, List, Optional, Sequence, Tuple
 
-from .manifold import InvalidSmilesError, make_batches, Manifold
+from .manifold import HAS_RDKIT, MAX_CONCURRENT_REQUESTS, InvalidSmilesError, TransientAPIError, canonical_smiles, json_dumps, json_loads, JSONDecodeError, make_batches, post_json_batches, Manifold
 
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
 
-@dataclass
-class ManifoldInchiKeyMatches:
-    is_exact: bool
-    parent: bool
-    connectivity: bool
+try:
+    from molbloom import buy as _bloom_buy
+except ImportError:
+    _bloom_buy = None
 
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
 
-@dataclass
-class ManifoldSupplierPurchaseInfo:
-    """ Purchase information for a supplier """
-    lead_time_weeks: float
-    price_information: str
-    is_building_block: bool
-    is_screening: bool
 
+if msgspec is not None:
+    # msgspec structs decode straight from response bytes into typed
+    # entries, fusing JSON parsing and object construction in one pass.
+    # The rename maps translate the wire keys to the field names below.
+    class ManifoldInchiKeyMatches(msgspec.Struct, frozen=True, rename={"is_exact": "exact"}):
+        is_exact: bool = False
+        parent: bool = False
+        connectivity: bool = False
 
-@dataclass
-class ManifoldCatalogEntry:
-    supplier: str
-    id: str
-    smiles: str
-    link: str
-    purchase_info: Optional[ManifoldSupplierPurchaseInfo]
-    match: Optional[ManifoldInchiKeyMatches]
+    class ManifoldSupplierPurchaseInfo(msgspec.Struct, frozen=True,
+                                       rename={"lead_time_weeks": "scrLeadTimeWeeks",
+                                               "price_information": "scrPriceRange",
+                                               "is_building_block": "isBuildingBlock",
+                                               "is_screening": "isScreening"}):
+        """ Purchase information for a supplier """
+        # All four fields are required so a partially populated purchaseInfo
+        # raises ValidationError and falls back to the lenient parser, which
+        # returns None for it - the same behaviour as the manual path.
+        lead_time_weeks: float
+        price_information: str
+        is_building_block: bool
+        is_screening: bool
+
+    class ManifoldCatalogEntry(msgspec.Struct, frozen=True,
+                               rename={"supplier": "catalogName",
+                                       "id": "catalogId",
+                                       "purchase_info": "purchaseInfo",
+                                       "match": "inchikeyMatches"}):
+        supplier: str = "N/A"
+        id: str = "N/A"
+        smiles: str = ""
+        link: str = "N/A"
+        purchase_info: Optional[ManifoldSupplierPurchaseInfo] = None
+        match: Optional[ManifoldInchiKeyMatches] = None
+
+    class _BatchItem(msgspec.Struct):
+        catalogEntries: List[ManifoldCatalogEntry] = []
+        error: Optional[str] = None
+
+    class _BatchResponse(msgspec.Struct):
+        results: List[_BatchItem] = []
+
+    _BATCH_DECODER = msgspec.json.Decoder(_BatchResponse)
+else:
+    @dataclass(slots=True, frozen=True)
+    class ManifoldInchiKeyMatches:
+        is_exact: bool
+        parent: bool
+        connectivity: bool
+
+    @dataclass(slots=True, frozen=True)
+    class ManifoldSupplierPurchaseInfo:
+        """ Purchase information for a supplier """
+        lead_time_weeks: float
+        price_information: str
+        is_building_block: bool
+        is_screening: bool
+
+    @dataclass(slots=True, frozen=True)
+    class ManifoldCatalogEntry:
+        supplier: str
+        id: str
+        smiles: str
+        link: str
+        purchase_info: Optional[ManifoldSupplierPurchaseInfo]
+        match: Optional[ManifoldInchiKeyMatches]
+
+    _BATCH_DECODER = None
+
+
+_PURCHASE_KEYS = frozenset(("scrLeadTimeWeeks", "scrPriceRange", "isBuildingBlock", "isScreening"))
 
 
 def parse_supplier_purchase_information(item: Dict) -> Optional[ManifoldSupplierPurchaseInfo]:
@@ -38,15 +100,12 @@ def parse_supplier_purchase_information(item: Dict) -> Optional[ManifoldSupplier
     :param item:
     :return:
     """
-    try:
-        lead_time = float(item["scrLeadTimeWeeks"])
-        price_information = item["scrPriceRange"]
-        is_building_block = bool(item["isBuildingBlock"])
-        is_screening = bool(item["isScreening"])
-    except KeyError:
+    if not _PURCHASE_KEYS.issubset(item):
         return None
-    else:
-        return ManifoldSupplierPurchaseInfo(lead_time, price_information, is_building_block, is_screening)
+    return ManifoldSupplierPurchaseInfo(float(item["scrLeadTimeWeeks"]),
+                                        item["scrPriceRange"],
+                                        bool(item["isBuildingBlock"]),
+                                        bool(item["isScreening"]))
 
 
 def _parse_inchi_matches(value: Dict) -> ManifoldInchiKeyMatches:
@@ -58,71 +117,133 @@ def _parse_inchi_matches(value: Dict) -> ManifoldInchiKeyMatches:
 
 
 def _parse_catalog_entries(values: Dict) -> List[ManifoldCatalogEntry]:
-    entries = []
+    entries: List[ManifoldCatalogEntry] = []
+    append = entries.append
+    entry = ManifoldCatalogEntry
+    parse_matches = _parse_inchi_matches
+    parse_purchase = parse_supplier_purchase_information
     item: Dict
     for item in values:
-        catalog_name: str = item.get("catalogName", "N/A")
-        catalog_id: str = item.get("catalogId", "N/A")
-        link: str = item.get("link", "N/A")
-        smiles: str = item.get("smiles", "")
-
-        matches: Optional[ManifoldInchiKeyMatches] = None
-        if item.get("inchikeyMatches", None) is not None:
-            matches = _parse_inchi_matches(item["inchikeyMatches"])
-
-        purchase_information: Optional[ManifoldSupplierPurchaseInfo] = None
-        if item.get("purchaseInfo", None) is not None:
-            purchase_information = parse_supplier_purchase_information(item["purchaseInfo"])
-
-        entries.append(
-                ManifoldCatalogEntry(catalog_name,
-                                     catalog_id,
-                                     smiles,
-                                     link,
-                                     purchase_information,
-                                     matches)
-                       )
+        get = item.get
+        matches = parse_matches(m) if (m := get("inchikeyMatches")) is not None else None
+        purchase_information = parse_purchase(p) if (p := get("purchaseInfo")) is not None else None
+        append(
+                entry(get("catalogName", "N/A"),
+                      get("catalogId", "N/A"),
+                      get("smiles", ""),
+                      get("link", "N/A"),
+                      purchase_information,
+                      matches)
+        )
     return entries
 
 
+def _parse_batch_response(return_values: Dict) -> List[List[ManifoldCatalogEntry]]:
+    results: List[List[ManifoldCatalogEntry]] = []
+    for item in return_values["results"]:
+        if "error" in item:
+            results.append([])
+        else:
+            results.append(_parse_catalog_entries(item["catalogEntries"]))
+    return results
+
+
+def _decode_batch_body(body: bytes) -> List[List[ManifoldCatalogEntry]]:
+    """ Fused bytes-to-typed-entries decode of one batch response body """
+    try:
+        items = _BATCH_DECODER.decode(body).results
+    except msgspec.ValidationError:
+        return _parse_batch_response(json_loads(body))
+    return [[] if item.error is not None else item.catalogEntries for item in items]
+
+
+def _parse_exact_body(status_code: int, content: bytes) -> Tuple[ManifoldCatalogEntry, ...]:
+    try:
+        results = json_loads(content)
+    except JSONDecodeError:
+        raise TransientAPIError("Response could not be decoded.")
+    if status_code == 422:
+        raise InvalidSmilesError(results["error"])
+    elif status_code == 500:
+        raise TransientAPIError("The server reported an internal error.")
+    return tuple(_parse_catalog_entries(results.get("results", [])))
+
+
+@functools.lru_cache(maxsize=4096)
+def _exact_lookup(smiles: str, api_key: str) -> Tuple[ManifoldCatalogEntry, ...]:
+    """ Queries the exact search endpoint for a single compound, memoizing the result """
+    response = Manifold._get_session().post(
+            url=ExactSearch.FULL_URL,
+            headers={"X-API-KEY": api_key},
+            data=json_dumps({"smiles": smiles,
+                             "queryThirdPartyServices": False})
+    )
+    return _parse_exact_body(response.status_code, response.content)
+
+
 class ExactSearch(Manifold):
-    """ Searches the PostEra Manifold for a number of suppliers for a specific compound """
+    """ Searches the PostEra Manifold for a number of suppliers for a specific compound
+
+        The search is not performed until fetch() (or fetch_async()) is called:
+
+        >>> entries = ExactSearch(smiles, api_key).fetch().result()
+    """
 
     URL = "exact/"
 
     def __init__(self, smiles: str, api_key: str):
         Manifold.__init__(self, api_key)
         self._smiles = smiles
+        self._results: Optional[List[ManifoldCatalogEntry]] = None
+        self._exact_matches: Optional[List[ManifoldCatalogEntry]] = None
 
-        response = requests.post(
-                url=self.api_endpoint(self.URL),
-                headers={"X-API-KEY": self._api_key},
-                json={"smiles": self._smiles,
-                      "queryThirdPartyServices": False}
-        )
-        self._results: List[ManifoldCatalogEntry]
-        status_code = response.status_code
+    def fetch(self) -> "ExactSearch":
+        """ Performs the blocking API lookup and returns self """
         try:
-            results = response.json()
-        except JSONDecodeError:
+            self._results = list(_exact_lookup(canonical_smiles(self._smiles), self._api_key))
+        except TransientAPIError:
             self._results = []
-        else:
-            if status_code == 422:
-                raise InvalidSmilesError(results["error"])
-            elif status_code == 500:
+        self._exact_matches = None
+        return self
+
+    async def fetch_async(self, session: "aiohttp.ClientSession") -> "ExactSearch":
+        """ Performs the API lookup on the given aiohttp session and returns self """
+        response = await session.post(
+                self.FULL_URL,
+                headers={"X-API-KEY": self._api_key,
+                         "Content-Type": "application/json"},
+                data=json_dumps({"smiles": self._smiles,
+                                 "queryThirdPartyServices": False})
+        )
+        async with response:
+            try:
+                self._results = list(_parse_exact_body(response.status, await response.read()))
+            except TransientAPIError:
                 self._results = []
-            else:
-                self._results = _parse_catalog_entries(results.get("results", []))
+        self._exact_matches = None
+        return self
 
     def result(self) -> List[ManifoldCatalogEntry]:
+        if self._results is None:
+            raise RuntimeError("Results are not available until fetch() has completed.")
         return self._results
 
     def result_exact_matches(self) -> List[ManifoldCatalogEntry]:
-        results = []
-        for entry in self._results:
-            if entry.match is not None and entry.match.is_exact:
-                results.append(entry)
-        return results
+        if self._exact_matches is None:
+            self._exact_matches = [entry for entry in self.result()
+                                   if entry.match is not None and entry.match.is_exact]
+        return self._exact_matches
+
+
+async def gather_exact(smiles_list: Sequence[str], api_key: str) -> List[ExactSearch]:
+    """ Fetches exact searches for many compounds concurrently on one aiohttp session """
+    if aiohttp is None:
+        raise ImportError("aiohttp must be installed to use gather_exact")
+    searches = [ExactSearch(smiles, api_key) for smiles in smiles_list]
+    connector = aiohttp.TCPConnector(limit_per_host=MAX_CONCURRENT_REQUESTS)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        await asyncio.gather(*(search.fetch_async(session) for search in searches))
+    return searches
 
 
 class ExactSearchBatch(Manifold):
@@ -130,24 +251,40 @@ class ExactSearchBatch(Manifold):
     URL = "exact/batch/"
     MAX_BATCH_SIZE = 1000
 
-    def __init__(self, smiles: List[str], api_key: str):
+    def __init__(self, smiles: Sequence[str], api_key: str, use_bloom: bool = True):
         Manifold.__init__(self, api_key)
-        self._smiles = smiles[:]
-        self._results: List = []
-
-        batches = make_batches(smiles, self.MAX_BATCH_SIZE)
-        for batch in batches:
-            response = requests.post(
-                    url=self.api_endpoint(self.URL),
-                    headers={"X-API-KEY": self._api_key},
-                    json={"smilesList": batch}
+        self._smiles = smiles if isinstance(smiles, tuple) else tuple(smiles)
+
+        unique = list(dict.fromkeys(self._smiles))
+        if use_bloom and _bloom_buy is not None and HAS_RDKIT:
+            # A negative from the Bloom filter means the compound is definitely
+            # not in the catalog, so only possible hits are worth a request.
+            # The filter hashes canonical SMILES, so the probe must
+            # canonicalize too (requiring RDKit) or non-canonical input forms
+            # would be false negatives.
+            unique = [s for s in unique if _bloom_buy(s, canonicalize=True)]
+        index = {s: i for i, s in enumerate(unique)}
+        payloads = [{"smilesList": batch} for batch in make_batches(unique, self.MAX_BATCH_SIZE)]
+        unique_results: List[List[ManifoldCatalogEntry]] = []
+        if _BATCH_DECODER is not None:
+            bodies = post_json_batches(
+                    self.FULL_URL,
+                    {"X-API-KEY": self._api_key},
+                    payloads,
+                    decode=False
+            )
+            for body in bodies:
+                unique_results.extend(_decode_batch_body(body))
+        else:
+            responses = post_json_batches(
+                    self.FULL_URL,
+                    {"X-API-KEY": self._api_key},
+                    payloads
             )
-            return_values = response.json()
-            for item in return_values["results"]:
-                if "error" in item:
-                    self._results.append([])
-                else:
-                    self._results.append(_parse_catalog_entries(item["catalogEntries"]))
+            for return_values in responses:
+                unique_results.extend(_parse_batch_response(return_values))
+        self._results: List[List[ManifoldCatalogEntry]] = [unique_results[index[s]] if s in index else []
+                                                           for s in self._smiles]
 
     def result(self) -> List:
         return self._results
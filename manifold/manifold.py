@@ -3,7 +3,75 @@
     A bare-bones python api for the PostEra Manifold API
 """
 __author__ = "Casper Steinmann"
-from typing import List
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import functools
+import time
+from typing import Dict, Iterator, List, Optional, Sequence
+
+import requests
+from requests.adapters import HTTPAdapter
+
+try:
+    import uvloop
+    uvloop.install()
+except ImportError:
+    pass
+
+try:
+    import aiohttp
+    from aiolimiter import AsyncLimiter
+except ImportError:
+    aiohttp = None
+
+try:
+    import requests_cache
+except ImportError:
+    requests_cache = None
+
+try:
+    import orjson
+    json_loads = orjson.loads
+    json_dumps = orjson.dumps
+    JSONDecodeError = orjson.JSONDecodeError
+except ImportError:
+    import json
+    json_loads = json.loads
+    JSONDecodeError = json.JSONDecodeError
+
+    def json_dumps(obj) -> bytes:
+        return json.dumps(obj).encode("utf-8")
+
+try:
+    import ijson.backends.yajl2_c as ijson
+except ImportError:
+    try:
+        import ijson
+    except ImportError:
+        ijson = None
+
+try:
+    from rdkit import Chem
+    HAS_RDKIT = True
+
+    def canonical_smiles(smiles: str) -> str:
+        """ Canonicalizes a SMILES string so cached lookups are independent of the input form """
+        molecule = Chem.MolFromSmiles(smiles)
+        if molecule is None:
+            return smiles.strip()
+        return Chem.MolToSmiles(molecule)
+except ImportError:
+    HAS_RDKIT = False
+
+    def canonical_smiles(smiles: str) -> str:
+        """ Fallback without RDKit: only strips surrounding whitespace """
+        return smiles.strip()
+
+MAX_CONCURRENT_REQUESTS = 64
+MAX_REQUESTS_PER_SECOND = 10
+MAX_RETRIES = 5
+MAX_WORKER_THREADS = 16
+CACHE_EXPIRE_SECONDS = 3600
 
 
 class InvalidSmilesError(ValueError):
@@ -14,14 +82,60 @@ class TooManyRequestsError(ValueError):
     pass
 
 
+class TransientAPIError(ValueError):
+    """ Raised for server errors and undecodable bodies so they are never memoized """
+    pass
+
+
 class Manifold(object):
     """ Base PostEra Manifold API class
 
     """
     URL_API = "https://api.postera.ai/api/v1/"
+    _session: Optional[requests.Session] = None
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        # Precompute the endpoint once per subclass so call sites avoid a
+        # string concatenation and method dispatch on every request.
+        if hasattr(cls, "URL"):
+            cls.FULL_URL = cls.URL_API + cls.URL
 
-    def __init__(self, api_key: str):
+    def __init__(self, api_key: str, cache_path: Optional[str] = None):
         self._api_key = api_key
+        if cache_path is not None:
+            self._enable_cache(cache_path)
+
+    @classmethod
+    def _get_session(cls) -> requests.Session:
+        """ Returns the shared session, reusing pooled connections across requests """
+        if Manifold._session is None:
+            session = requests.Session()
+            Manifold._session = cls._setup_session(session)
+        return Manifold._session
+
+    @classmethod
+    def _enable_cache(cls, cache_path: str) -> None:
+        """ Replaces the shared session with one backed by an on-disk response cache
+
+        Cached responses expire after CACHE_EXPIRE_SECONDS and survive
+        process restarts. Requires the optional requests-cache package.
+        """
+        if requests_cache is None:
+            raise ImportError("requests-cache must be installed to use cache_path")
+        if isinstance(Manifold._session, requests_cache.CachedSession):
+            return
+        session = requests_cache.CachedSession(cache_path,
+                                               allowable_methods=("GET", "POST"),
+                                               match_headers=False,
+                                               expire_after=CACHE_EXPIRE_SECONDS)
+        Manifold._session = cls._setup_session(session)
+
+    @staticmethod
+    def _setup_session(session: requests.Session) -> requests.Session:
+        session.mount("https://", HTTPAdapter(pool_connections=8, pool_maxsize=64))
+        session.headers["Content-Type"] = "application/json"
+        return session
 
     def api_key(self) -> str:
         return self._api_key
@@ -34,9 +148,90 @@ class Manifold(object):
         raise NotImplementedError
 
 
-def make_batches(values: List[str], batch_size: int) -> List[List[str]]:
-    """ Constructs a number of batches of size `batch_size` from the input data"""
-    batches: List[List[str]] = []
+def make_batches(values: Sequence[str], batch_size: int) -> Iterator[Sequence[str]]:
+    """ Lazily yields batches of size `batch_size` from the input data"""
     for i in range(0, len(values), batch_size):
-        batches.append(values[i:i + batch_size])
-    return batches
+        yield values[i:i + batch_size]
+
+
+async def _decode_response(response: "aiohttp.ClientResponse") -> Dict:
+    """ Decodes a response body, incrementally when a streaming parser is available
+
+    With ijson installed the JSON document is parsed as it arrives on the
+    wire, which overlaps network transfer with parsing and avoids
+    buffering the raw body of a multi-MB batch response next to the
+    decoded dictionary.
+    """
+    if ijson is not None:
+        async for document in ijson.items(response.content, ""):
+            return document
+        return {}
+    return json_loads(await response.read())
+
+
+async def _post_payload(session: "aiohttp.ClientSession",
+                        semaphore: "asyncio.Semaphore",
+                        limiter: "AsyncLimiter",
+                        url: str,
+                        headers: Dict[str, str],
+                        payload: bytes,
+                        decode: bool) -> Dict:
+    """ POSTs a single payload, retrying with exponential backoff when throttled """
+    async with semaphore:
+        for attempt in range(MAX_RETRIES):
+            async with limiter:
+                response = await session.post(url, headers=headers, data=payload)
+            async with response:
+                if response.status != 429:
+                    if not decode:
+                        return await response.read()
+                    return await _decode_response(response)
+            await asyncio.sleep(2 ** attempt)
+    raise TooManyRequestsError("Request was rate limited after {0:d} retries.".format(MAX_RETRIES))
+
+
+async def _post_all(url: str, headers: Dict[str, str], payloads: List[Dict], decode: bool) -> List[Dict]:
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+    limiter = AsyncLimiter(MAX_REQUESTS_PER_SECOND, 1)
+    headers = dict(headers, **{"Content-Type": "application/json"})
+    connector = aiohttp.TCPConnector(limit_per_host=MAX_CONCURRENT_REQUESTS)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        tasks = [_post_payload(session, semaphore, limiter, url, headers, json_dumps(payload), decode)
+                 for payload in payloads]
+        return list(await asyncio.gather(*tasks))
+
+
+def _post_one(url: str, headers: Dict[str, str], decode: bool, payload: bytes) -> Dict:
+    """ POSTs a single payload over the shared session, retrying when throttled """
+    session = Manifold._get_session()
+    for attempt in range(MAX_RETRIES):
+        response = session.post(url, headers=headers, data=payload)
+        if response.status_code != 429:
+            if not decode:
+                return response.content
+            return json_loads(response.content)
+        time.sleep(2 ** attempt)
+    raise TooManyRequestsError("Request was rate limited after {0:d} retries.".format(MAX_RETRIES))
+
+
+def _post_batches_threaded(url: str, headers: Dict[str, str], payloads: List[Dict], decode: bool) -> List[Dict]:
+    """ Thread-pool alternative to _post_all; requests releases the GIL during socket I/O """
+    headers = dict(headers, **{"Content-Type": "application/json"})
+    serialized = [json_dumps(payload) for payload in payloads]
+    with ThreadPoolExecutor(max_workers=min(MAX_WORKER_THREADS, len(serialized))) as executor:
+        return list(executor.map(functools.partial(_post_one, url, headers, decode), serialized))
+
+
+def post_json_batches(url: str, headers: Dict[str, str], payloads: List[Dict], decode: bool = True) -> List:
+    """ POSTs all payloads to `url` concurrently and returns the responses in order
+
+    Responses are decoded to dictionaries unless `decode` is False, in
+    which case the raw body bytes are returned for callers with their
+    own (typed) decoder.
+    """
+    payloads = list(payloads)
+    if not payloads:
+        return []
+    if aiohttp is None:
+        return _post_batches_threaded(url, headers, payloads, decode)
+    return asyncio.run(_post_all(url, headers, payloads, decode))
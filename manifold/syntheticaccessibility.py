@@ -1,12 +1,16 @@
 from dataclasses import dataclass
-import requests
-from typing import Dict, List, Optional
-from simplejson.errors import JSONDecodeError
+import functools
+from typing import Dict, List, Optional, Sequence
 
-from .manifold import InvalidSmilesError, TooManyRequestsError, make_batches, Manifold
+import numpy as np
 
+from .manifold import InvalidSmilesError, TooManyRequestsError, TransientAPIError, canonical_smiles, json_dumps, json_loads, JSONDecodeError, make_batches, post_json_batches, Manifold
 
-@dataclass
+
+_MISSING = object()
+
+
+@dataclass(slots=True, frozen=True)
 class ManifoldSyntheticAccessibility:
     score: float
     num_steps: Optional[int]
@@ -29,14 +33,16 @@ def parse_synthetic_accessibility(sa_entry: Dict) -> ManifoldSyntheticAccessibil
     num_steps: Optional[int] = sa_entry.get("minNumSteps", None)
     warning: Optional[str] = sa_entry.get("SAAlertLevel", None)
     url: Optional[str]
-    if "fastSAScore" in sa_entry:
-        score = sa_entry.get("fastSAScore", 1.0)
+    fast_score = sa_entry.get("fastSAScore", _MISSING)
+    if fast_score is not _MISSING:
+        score = float(fast_score)
         url = sa_entry.get("SAAlertImgURL", None)
-    elif "score" in sa_entry:
-        score = sa_entry.get("score", 1.0)
-        url = sa_entry.get("manifoldLink", None)
     else:
-        raise ValueError("Could not parse synthetic accessibility.")
+        retro_score = sa_entry.get("score", _MISSING)
+        if retro_score is _MISSING:
+            raise ValueError("Could not parse synthetic accessibility.")
+        score = float(retro_score)
+        url = sa_entry.get("manifoldLink", None)
     return ManifoldSyntheticAccessibility(score=score,
                                           num_steps=num_steps,
                                           warning=warning,
@@ -45,51 +51,99 @@ def parse_synthetic_accessibility(sa_entry: Dict) -> ManifoldSyntheticAccessibil
 
 def parse_synthetic_accessibilities(sa_entries: List[Dict]) -> List[Optional[ManifoldSyntheticAccessibility]]:
     results: List[Optional[ManifoldSyntheticAccessibility]] = []
+    append = results.append
+    parse = parse_synthetic_accessibility
     for sa_data in sa_entries:
-        try:
-            value = sa_data["SAData"]
-        except KeyError:
-            results.append(None)
-        else:
-            results.append(parse_synthetic_accessibility(value))
+        append(parse(value) if (value := sa_data.get("SAData")) is not None else None)
 
     return results
 
 
+def _parse_sa_body(status_code: int, content: bytes) -> ManifoldSyntheticAccessibility:
+    try:
+        results = json_loads(content)
+    except JSONDecodeError:
+        raise TransientAPIError("Response could not be decoded.")
+    if status_code == 500:
+        raise TransientAPIError("The server reported an internal error.")
+    elif status_code == 422:
+        raise InvalidSmilesError(results["error"])
+    if "detail" in results:
+        raise TooManyRequestsError(results["detail"])
+    return parse_synthetic_accessibility(results)
+
+
+def _parse_sa_response(response) -> ManifoldSyntheticAccessibility:
+    return _parse_sa_body(response.status_code, response.content)
+
+
+@functools.lru_cache(maxsize=4096)
+def _fast_sa_lookup(smiles: str, api_key: str, alerts: bool) -> ManifoldSyntheticAccessibility:
+    """ Queries the fast-score endpoint for a single compound, memoizing the result """
+    response = Manifold._get_session().post(
+            url=SyntheticAccessibilityFast.FULL_URL,
+            headers={"X-API-KEY": api_key},
+            data=json_dumps({"smiles": smiles,
+                             "getAlertSvg": alerts})
+    )
+    return _parse_sa_response(response)
+
+
 class SyntheticAccessibility(Manifold):
+    """ Scores a single compound; call fetch() (or fetch_async()) to run the query """
+
     def __init__(self, smiles: str, api_key: str):
         Manifold.__init__(self, api_key)
         self._smiles: str = smiles
-        self._results: Optional[ManifoldSyntheticAccessibility]
-        response = self._setup_request()
-        self._parse_response(response)
+        self._results: Optional[ManifoldSyntheticAccessibility] = None
+        self._fetched: bool = False
 
-    def _setup_request(self):
-        raise NotImplementedError
-
-    def _parse_response(self, response):
-        status_code = response.status_code
+    def fetch(self) -> "SyntheticAccessibility":
+        """ Performs the blocking API lookup and returns self """
         try:
-            results = response.json()
-        except JSONDecodeError:
+            self._results = self._lookup()
+        except TransientAPIError:
             self._results = None
-        else:
-            if status_code == 500:
+        self._fetched = True
+        return self
+
+    async def fetch_async(self, session) -> "SyntheticAccessibility":
+        """ Performs the API lookup on the given aiohttp session and returns self """
+        response = await session.post(
+                self.FULL_URL,
+                headers={"X-API-KEY": self._api_key,
+                         "Content-Type": "application/json"},
+                data=json_dumps(self._payload())
+        )
+        async with response:
+            try:
+                self._results = _parse_sa_body(response.status, await response.read())
+            except TransientAPIError:
                 self._results = None
-            elif status_code == 422:
-                raise InvalidSmilesError(results["error"])
-            else:
-                if "detail" in results:
-                    raise TooManyRequestsError(results["detail"])
-                self._results = parse_synthetic_accessibility(results)
+        self._fetched = True
+        return self
+
+    def _lookup(self) -> ManifoldSyntheticAccessibility:
+        response = self._get_session().post(
+                url=self.FULL_URL,
+                headers={"X-API-KEY": self._api_key},
+                data=json_dumps(self._payload())
+        )
+        return _parse_sa_response(response)
+
+    def _payload(self) -> Dict:
+        raise NotImplementedError
 
     def result(self) -> Optional[ManifoldSyntheticAccessibility]:
+        if not self._fetched:
+            raise RuntimeError("Results are not available until fetch() has completed.")
         return self._results
 
     def as_floats(self) -> float:
-        if self._results is None:
+        results = self.result()
+        if results is None:
             return 1.0
-        return self._results.score
+        return results.score
 
 
 class SyntheticAccessibilityFast(SyntheticAccessibility):
@@ -99,13 +153,12 @@ class SyntheticAccessibilityFast(SyntheticAccessibility):
         self._alerts: bool = alerts
         SyntheticAccessibility.__init__(self, smiles, api_key)
 
-    def _setup_request(self):
-        return requests.post(
-                url=self.api_endpoint(self.URL),
-                headers={"X-API-KEY": self._api_key},
-                json={"smiles": self._smiles,
-                      "getAlertSvg": self._alerts}
-        )
+    def _lookup(self) -> ManifoldSyntheticAccessibility:
+        return _fast_sa_lookup(canonical_smiles(self._smiles), self._api_key, self._alerts)
+
+    def _payload(self) -> Dict:
+        return {"smiles": self._smiles,
+                "getAlertSvg": self._alerts}
 
 
 class SyntheticAccessibilityRetroSynthesis(SyntheticAccessibility):
@@ -114,12 +167,8 @@ class SyntheticAccessibilityRetroSynthesis(SyntheticAccessibility):
     def __init__(self, smiles: str, api_key: str):
         SyntheticAccessibility.__init__(self, smiles, api_key)
 
-    def _setup_request(self):
-        return requests.post(
-                url=self.api_endpoint(self.URL),
-                headers={"X-API-KEY": self._api_key},
-                json={"smiles": self._smiles}
-        )
+    def _payload(self) -> Dict:
+        return {"smiles": self._smiles}
 
 
 class SyntheticAccessibilityBatch(Manifold):
@@ -131,70 +180,75 @@ class SyntheticAccessibilityBatch(Manifold):
     """
     MAX_BATCH_SIZE: int
 
-    def __init__(self, smiles: List[str], api_key: str):
+    def __init__(self, smiles: Sequence[str], api_key: str):
         Manifold.__init__(self, api_key)
-        self._smiles = smiles[:]
-        self._results: List[Optional[ManifoldSyntheticAccessibility]] = []
-        responses = self._setup_requests()
-        self._parse_response(responses)
-
-    def _setup_requests(self):
-        batches = make_batches(self._smiles, self.MAX_BATCH_SIZE)
-        responses = []
-        for batch in batches:
-            response = self._setup_request(batch)
-            responses.append(response.json())
-        return responses
-
-    def _setup_request(self, batch: List[str]):
+        self._smiles = smiles if isinstance(smiles, tuple) else tuple(smiles)
+
+        unique = list(dict.fromkeys(self._smiles))
+        index = {s: i for i, s in enumerate(unique)}
+        responses = self._setup_requests(unique)
+        unique_results = self._parse_response(responses)
+        self._results: List[Optional[ManifoldSyntheticAccessibility]] = [unique_results[index[s]]
+                                                                         for s in self._smiles]
+        self._scores = np.fromiter((m.score if m is not None else 1.0 for m in self._results),
+                                   dtype=np.float32,
+                                   count=len(self._results))
+
+    def _setup_requests(self, smiles: Sequence[str]):
+        payloads = [self._make_payload(batch)
+                    for batch in make_batches(smiles, self.MAX_BATCH_SIZE)]
+        return post_json_batches(
+                self.FULL_URL,
+                {"X-API-KEY": self._api_key},
+                payloads
+        )
+
+    def _make_payload(self, batch: Sequence[str]) -> Dict:
         raise NotImplementedError
 
-    def _parse_response(self, responses):
+    def _parse_response(self, responses) -> List[Optional[ManifoldSyntheticAccessibility]]:
+        results: List[Optional[ManifoldSyntheticAccessibility]] = []
         for response in responses:
             try:
-                results = response["results"]
+                values = response["results"]
             except KeyError:
                 if "detail" in response:
                     raise TooManyRequestsError(response["detail"])
                 else:
                     raise KeyError
             else:
-                self._results.extend(parse_synthetic_accessibilities(results))
+                results.extend(parse_synthetic_accessibilities(values))
+        return results
 
     def result(self) -> List[Optional[ManifoldSyntheticAccessibility]]:
         return self._results
 
-    def as_floats(self) -> List[float]:
-        return [m.score if m is not None else 1.0 for m in self._results]
+    def as_floats(self) -> np.ndarray:
+        return self._scores
+
+    def as_list_floats(self) -> List[float]:
+        return self._scores.tolist()
 
 
 class SyntheticAccessibilityFastBatch(SyntheticAccessibilityBatch):
     URL = "synthetic-accessibility/fast-score/batch/"
     MAX_BATCH_SIZE = 100
 
-    def __init__(self, smiles: List[str], api_key: str, alerts: bool = False):
+    def __init__(self, smiles: Sequence[str], api_key: str, alerts: bool = False):
         self._alerts = alerts
         SyntheticAccessibilityBatch.__init__(self, smiles, api_key)
 
-    def _setup_request(self, batch: List[str]):
-        return requests.post(
-                url=self.api_endpoint(self.URL),
-                headers={"X-API-KEY": self._api_key},
-                json={"smilesList": batch,
-                      "getAlertSvg": self._alerts}
-        )
+    def _make_payload(self, batch: Sequence[str]) -> Dict:
+        return {"smilesList": batch,
+                "getAlertSvg": self._alerts}
 
 
 class SyntheticAccessibilityRetroSynthesisBatch(SyntheticAccessibilityBatch):
     URL = "synthetic-accessibility/retrosynthesis/batch/"
     MAX_BATCH_SIZE = 10
 
-    def __init__(self, smiles: List[str], api_key: str):
+    def __init__(self, smiles: Sequence[str], api_key: str):
         SyntheticAccessibilityBatch.__init__(self, smiles, api_key)
 
-    def _setup_request(self, batch: List[str]):
-        return requests.post(
-                url=self.api_endpoint(self.URL),
-                headers={"X-API-KEY": self._api_key},
-                json={"smilesList": batch}
-        )
+    def _make_payload(self, batch: Sequence[str]) -> Dict:
+        return {"smilesList": batch}